@@ -0,0 +1,49 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+class _ChunkSink:
+    # Write-only file object whose bytes are handed to the response as they are produced.
+    # tell() keeps counting across drains so the writers' footer offsets stay correct.
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+async def iter_arrow(header, partitions, report_format):
+    # Each batch of report rows becomes one record batch (a row group for Parquet)
+    schema = pa.schema([(name, pa.timestamp("us") if name == "timestamp" else pa.string()) for name in header])
+    sink = _ChunkSink()
+    if report_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(sink, schema, options=pa.ipc.IpcWriteOptions(compression="lz4"))
+    async for rows in partitions:
+        if not rows:
+            continue
+        # Timestamps arrive as ISO strings; Arrow parses them in C++
+        columns = [pa.array(column, type=pa.string()).cast(field.type) for column, field in zip(zip(*rows), schema)]
+        writer.write_batch(pa.record_batch(columns, schema=schema))
+        if data := sink.drain():
+            yield data
+    writer.close()
+    yield sink.drain()
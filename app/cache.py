@@ -0,0 +1,117 @@
+import glob
+import os
+
+from cachetools import TTLCache
+from sqlalchemy import select
+
+from app.config import REPORT_CACHE_DIR
+from app.models import Admin, Course, Department, Level
+
+# Short-lived caches for rows read on almost every request but rarely changed.
+# Entries are Row snapshots of the table's columns, not ORM instances: a rollback on
+# the request's session expires every instance it loaded, which would break a cached one for its whole TTL.
+course_by_code = TTLCache(maxsize=1024, ttl=60)
+course_by_id = TTLCache(maxsize=1024, ttl=60)
+admin_by_username = TTLCache(maxsize=1024, ttl=60)
+# Departments and levels are reference data with no write endpoints, so they can be kept longer
+department_by_id = TTLCache(maxsize=1024, ttl=300)
+level_by_id = TTLCache(maxsize=1024, ttl=300)
+
+async def _load_snapshot(db, model, *criteria):
+    # Immutable and not tracked by the session; attribute access matches the ORM model
+    return (await db.execute(select(*model.__table__.columns).where(*criteria))).first()
+
+def _remember_course(course):
+    course_by_code[course.course_code] = course
+    course_by_id[course.course_id] = course
+    return course
+
+async def get_course_by_code(db, course_code):
+    course = course_by_code.get(course_code)
+    if course is None:
+        course = await _load_snapshot(db, Course, Course.course_code == course_code)
+        if course is not None:
+            _remember_course(course)
+    return course
+
+async def get_course_by_id(db, course_id):
+    course = course_by_id.get(course_id)
+    if course is None:
+        course = await _load_snapshot(db, Course, Course.course_id == course_id)
+        if course is not None:
+            _remember_course(course)
+    return course
+
+async def get_department_by_id(db, department_id):
+    department = department_by_id.get(department_id)
+    if department is None:
+        department = await _load_snapshot(db, Department, Department.department_id == department_id)
+        if department is not None:
+            department_by_id[department_id] = department
+    return department
+
+async def get_level_by_id(db, level_id):
+    level = level_by_id.get(level_id)
+    if level is None:
+        level = await _load_snapshot(db, Level, Level.level_id == level_id)
+        if level is not None:
+            level_by_id[level_id] = level
+    return level
+
+async def get_admin_by_username(db, username):
+    admin = admin_by_username.get(username)
+    if admin is None:
+        admin = await _load_snapshot(db, Admin, Admin.username == username)
+        if admin is not None:
+            admin_by_username[username] = admin
+    return admin
+
+# Reports of ended sessions are cached on disk so every worker can serve them without re-querying.
+# Writers of attendance, error logs and course lists call invalidate_reports after committing.
+# File names carry the report version, so a download that finishes after an invalidation can only
+# write back an entry for its own (old) version, never over newer content.
+def report_cache_path(session_id, kind, version="*"):
+    return os.path.join(REPORT_CACHE_DIR, f"report_{session_id}_{kind}_{version}.csv")
+
+async def cache_report(chunks, path):
+    # Tee the streamed report to a temp file; it only replaces the cache entry once complete
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{id(chunks)}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            async for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+CACHED_REPORT_READ_SIZE = 64 * 1024  # bytes per chunk when streaming a cached report
+
+def open_cached_report(path):
+    # Returns (size, chunks), or None on a cache miss. The file is opened before the response starts,
+    # so an invalidate_reports in another worker can unlink it without breaking the download.
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    def chunks():
+        with f:
+            while True:
+                chunk = f.read(CACHED_REPORT_READ_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    return os.fstat(f.fileno()).st_size, chunks()
+
+def invalidate_reports(session_id="*", kind="*"):
+    for path in glob.glob(report_cache_path(session_id, kind)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
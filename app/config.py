@@ -1,8 +1,24 @@
 from dotenv import load_dotenv #imports function to load .env files
 import os  #access environment variables
+import tempfile  #default location for the report cache
 
-load_dotenv()  #fetch variables from a .env file into the environment
+if not getattr(load_dotenv, "_done", False):  #only parse .env once per process, even on re-import
+    load_dotenv()  #fetch variables from a .env file into the environment
+    load_dotenv._done = True
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+if DATABASE_URL and DATABASE_URL.startswith(("postgres://", "postgresql://")):  #async engine needs the asyncpg driver
+    DATABASE_URL = "postgresql+asyncpg://" + DATABASE_URL.split("://", 1)[1]
+elif DATABASE_URL and DATABASE_URL.startswith("sqlite://"):  #local/dev databases use the aiosqlite driver
+    DATABASE_URL = "sqlite+aiosqlite://" + DATABASE_URL.split("://", 1)[1]
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))  #persistent connections kept per worker
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))  #extra connections allowed during bursts
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", "5"))  #connections opened at startup so early requests skip the handshake
+DB_AUTO_CREATE = os.getenv("DB_AUTO_CREATE", "true").lower() in ("1", "true", "yes")  #create missing tables/indexes on startup
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "").lower() in ("1", "true", "yes")  #DATABASE_URL points at PgBouncer (transaction pooling)
 SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = "HS256"  #common algo for jwt encoding 
\ No newline at end of file
+SECRET_KEY_BYTES = SECRET_KEY.encode("utf-8") if SECRET_KEY else None  #pre-encoded once for jwt signing
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "authentify_reports"))  #CSV reports of ended sessions
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  #work factor for new password hashes; existing hashes keep theirs
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  #DEBUG logs every request's details, so keep it off in production
+ALGORITHM = "HS256"  #common algo for jwt encoding 
@@ -1,85 +1,292 @@
-import pandas as pd
+import asyncio
+import codecs
+import csv
 import io
+import itertools
+import math
+import queue
+from contextlib import contextmanager
+from anyio import to_thread
 from fastapi import HTTPException
+from sqlalchemy import and_, case, func, insert, select
 
-from app.models import Student
+from app.models import SessionLocal, engine, Student, CourseList, Attendance, ErrorLog
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
-
-def generate_enrollment_list_csv(students, department_id, level_id):
-    if not students:
-        raise HTTPException(status_code=404, detail="No students found")
-    data = [
-        {"matriculation_number": s.matriculation_number, "name": s.name}
-        for s in students
-    ]
-    df = pd.DataFrame(data)
-    stream = io.StringIO()
-    df.to_csv(stream, index=False)
-    return stream.getvalue()
-
-
-
-
-def parse_course_list_csv(content, course_id, db):
-    df = pd.read_csv(io.BytesIO(content))
-    required_columns = ["matriculation_number", "name", "ca_mark"]
-    if not all(col in df.columns for col in required_columns):
-        raise HTTPException(status_code=400, detail="CSV missing required columns")
-    
-    logging.debug(f"CSV columns: {df.columns.tolist()}")
-    logging.debug(f"CSV data: {df.to_dict(orient='records')}")
-    
-    course_lists = []
-    for _, row in df.iterrows():
-        matric = row["matriculation_number"]
-        student = db.query(Student).filter(Student.matriculation_number == matric).first()
-        logging.debug(f"Checking student {matric}: {'Found' if student else 'Not found'}")
-        if student:
-            ca_mark = row["ca_mark"]
-            logging.debug(f"Raw ca_mark for {matric}: {ca_mark}, Type: {type(ca_mark)}")
-            try:
-                ca_mark_value = float(ca_mark) if pd.notna(ca_mark) else None
-            except (ValueError, TypeError):
-                logging.debug(f"Invalid ca_mark for {matric}: {ca_mark}")
-                ca_mark_value = None
-            course_lists.append({
-                "course_id": course_id,
-                "matriculation_number": matric,
-                "ca_mark": ca_mark_value
-            })
-    logging.debug(f"Course lists to insert: {course_lists}")
-    return course_lists
+logger = logging.getLogger(__name__)
+
+IN_CHUNK_SIZE = 1000  # keep IN lists well under driver bind-parameter limits
+
+CSV_CHUNK_ROWS = 1000  # rows serialized per chunk handed to StreamingResponse
+
+# Report download formats and their media types; the first is the default
+REPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "feather": "application/vnd.apache.arrow.file"
+}
+
+async def stream_partitions(query, chunk_size=CSV_CHUNK_ROWS):
+    # The request's session is closed before a StreamingResponse body runs, so stream on our own.
+    # chunk_size rows are fetched per round trip and serialized per flushed chunk.
+    async with SessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=chunk_size))
+        async for partition in result.partitions():
+            yield partition
+
+_BUF_POOL = queue.LifoQueue(maxsize=32)  # StringIO buffers reused across CSV responses
+
+@contextmanager
+def borrow_buf():
+    try:
+        buf = _BUF_POOL.get_nowait()
+    except queue.Empty:
+        buf = io.StringIO()
+    buf.seek(0)
+    buf.truncate(0)
+    try:
+        yield buf
+    finally:
+        try:
+            _BUF_POOL.put_nowait(buf)
+        except queue.Full:
+            pass
+
+def _quote(value):
+    # Minimal CSV quoting for one text field (bare \r is quoted too, so readers never split on it)
+    if value is None:
+        return ""
+    if '"' in value or "," in value or "\n" in value or "\r" in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+# Fixed-schema row formatters: roughly 3x faster than csv.writer.writerows on report-sized batches.
+# Status and ISO timestamp columns never need quoting; free-text columns go through _quote.
+def _format_enrollment_row(row):
+    matric, name = row
+    return f"{_quote(matric)},{_quote(name)}\n"
+
+def _format_attendance_row(row):
+    matric, name, status, timestamp = row
+    return f"{_quote(matric)},{_quote(name)},{status},{timestamp or ''}\n"
+
+def _format_error_row(row):
+    matric, error_type, details, timestamp = row
+    return f"{_quote(matric)},{_quote(error_type)},{_quote(details)},{timestamp}\n"
 
+async def iter_csv(header, partitions, format_row=None):
+    # Yield one CSV chunk per batch of rows so the full file is never held in memory
+    with borrow_buf() as stream:
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(header)
+        async for rows in partitions:
+            if format_row is None:
+                writer.writerows(rows)
+            else:
+                stream.write("".join(map(format_row, rows)))
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate(0)
+        if stream.tell():
+            yield stream.getvalue()
 
+async def enrollment_list_version(db, department_id, level_id):
+    # Students are only ever inserted, so the count and highest matriculation number change with the list
+    return (await db.execute(select(func.count(), func.max(Student.matriculation_number)).where(
+        Student.department_id == department_id,
+        Student.level_id == level_id
+    ))).one()
 
+def generate_enrollment_list_csv(department_id, level_id):
+    query = select(Student.matriculation_number, Student.name).where(
+        Student.department_id == department_id,
+        Student.level_id == level_id
+    )
+    return iter_csv(("matriculation_number", "name"), stream_partitions(query), _format_enrollment_row)
 
+ISO_TIMESTAMP_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.US'  # to_char pattern matching datetime.isoformat()
 
+async def copy_csv(query):
+    # PostgreSQL renders the CSV itself via COPY ... TO STDOUT; chunks are relayed through a bounded queue
+    sql = str(query.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+    chunks = asyncio.Queue(maxsize=16)
 
+    async def copy():
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.copy_from_query(sql, output=chunks.put, format="csv", header=True)
+        except Exception as e:
+            await chunks.put(e)
+            return
+        await chunks.put(None)
 
+    task = asyncio.create_task(copy())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        task.cancel()
 
+def _attendance_roster(session_id, course_id, *columns):
+    # One pass over the course list: a LEFT JOIN on attendance marks who is present and who is absent
+    return select(*columns).select_from(CourseList).join(
+        Student, CourseList.matriculation_number == Student.matriculation_number
+    ).outerjoin(
+        Attendance, and_(
+            Attendance.matriculation_number == Student.matriculation_number,
+            Attendance.session_id == session_id
+        )
+    ).where(CourseList.course_id == course_id).distinct()
 
+async def _attendance_report_rows(query, chunk_size):
+    async for partition in stream_partitions(query, chunk_size):
+        yield [
+            (matric, name, "Present" if authenticated else "Absent", timestamp.isoformat() if authenticated else None)
+            for matric, name, authenticated, timestamp in partition
+            if authenticated or authenticated is None
+        ]
 
+def export_rows(header, partitions, report_format="csv", format_row=None):
+    if report_format == "csv":
+        return iter_csv(header, partitions, format_row)
+    from app.arrow_export import iter_arrow  # pyarrow is only imported once a binary format is requested
+    return iter_arrow(header, partitions, report_format)
 
+async def attendance_report_version(db, session_id, course_id):
+    # Attendance rows are append-only and roster uploads insert fresh course_list ids,
+    # so counts and max ids change whenever the report content can
+    return (await db.execute(select(
+        select(func.count(Attendance.id)).where(Attendance.session_id == session_id).scalar_subquery(),
+        select(func.max(Attendance.id)).where(Attendance.session_id == session_id).scalar_subquery(),
+        select(func.count(CourseList.id)).where(CourseList.course_id == course_id).scalar_subquery(),
+        select(func.max(CourseList.id)).where(CourseList.course_id == course_id).scalar_subquery()
+    ))).one()
 
+def generate_attendance_report(session_id, course_id, report_format="csv", chunk_size=CSV_CHUNK_ROWS):
+    # Present students are listed before absent ones
+    if report_format == "csv" and engine.dialect.name == "postgresql":
+        status = case((Attendance.authenticated, "Present"), else_="Absent").label("status")
+        query = _attendance_roster(
+            session_id, course_id,
+            Student.matriculation_number, Student.name, status,
+            case((Attendance.authenticated, func.to_char(Attendance.timestamp, ISO_TIMESTAMP_FORMAT))).label("timestamp")
+        ).where(Attendance.authenticated.is_not(False)).order_by(status.desc())
+        return copy_csv(query)
+    query = _attendance_roster(
+        session_id, course_id,
+        Student.matriculation_number, Student.name, Attendance.authenticated, Attendance.timestamp
+    ).order_by(Attendance.authenticated.desc().nulls_last())
+    return export_rows(("matriculation_number", "name", "status", "timestamp"), _attendance_report_rows(query, chunk_size), report_format, _format_attendance_row)
 
+async def _error_report_rows(query, chunk_size):
+    async for partition in stream_partitions(query, chunk_size):
+        yield [
+            (matric or "Unknown", error_type, details, timestamp.isoformat())
+            for matric, error_type, details, timestamp in partition
+        ]
 
+async def error_report_version(db, session_id):
+    # Error logs are append-only
+    return (await db.execute(
+        select(func.count(ErrorLog.id), func.max(ErrorLog.id)).where(ErrorLog.session_id == session_id)
+    )).one()
 
+def generate_error_report(session_id, report_format="csv", chunk_size=CSV_CHUNK_ROWS):
+    if report_format == "csv" and engine.dialect.name == "postgresql":
+        # Timestamps are formatted and missing matriculation numbers filled in by PostgreSQL, not per row in Python
+        return copy_csv(select(
+            func.coalesce(ErrorLog.matriculation_number, "Unknown").label("matriculation_number"),
+            ErrorLog.error_type, ErrorLog.details,
+            func.to_char(ErrorLog.timestamp, ISO_TIMESTAMP_FORMAT).label("timestamp")
+        ).where(ErrorLog.session_id == session_id))
+    query = select(
+        ErrorLog.matriculation_number, ErrorLog.error_type, ErrorLog.details, ErrorLog.timestamp
+    ).where(ErrorLog.session_id == session_id)
+    return export_rows(("matriculation_number", "error_type", "details", "timestamp"), _error_report_rows(query, chunk_size), report_format, _format_error_row)
+
+
+
+
+def _to_float(value):
+    try:
+        number = float(value)
+    except (ValueError, TypeError):
+        return None
+    return number if math.isfinite(number) else None  # NaN/inf are not marks
+
+
+def _ca_marks(column):
+    # Vectorized string -> float cast; values Arrow can't parse (e.g. padded with spaces) fall back to _to_float
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    try:
+        marks = pc.cast(column, pa.float64())
+    except pa.ArrowInvalid:
+        return [_to_float(value) for value in column.to_pylist()]
+    return pc.if_else(pc.is_finite(marks), marks, None).to_pylist()
+
+def _iter_course_list_rows(file, required_columns):
+    # The upload's spooled file is parsed block by block by Arrow's C++ CSV reader
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    header = next(csv.reader(codecs.iterdecode(file, "utf-8-sig")), [])
+    missing = set(required_columns).difference(header)
+    if missing:
+        raise HTTPException(status_code=400, detail=f"CSV missing required columns: {', '.join(sorted(missing))}")
+    logger.debug("CSV columns: %s", header)
+    if not file.read(1):
+        return  # header only: no rows, and pyarrow 17 aborts the process on a body that ends at the header
+    file.seek(0)
+    reader = pa_csv.open_csv(
+        file,
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),  # quoted fields may span lines (RFC 4180)
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=["matriculation_number", "ca_mark"],
+            column_types={"matriculation_number": pa.string(), "ca_mark": pa.string()},
+            strings_can_be_null=True,
+            null_values=[""]
+        )
+    )
+    for batch in reader:
+        yield from zip(batch.column(0).to_pylist(), _ca_marks(batch.column(1)))
+
+def _take(rows, count):
+    return list(itertools.islice(rows, count))
+
+async def parse_course_list_csv(file, course_id, db):
+    # Yields insert-ready rows IN_CHUNK_SIZE at a time, so neither the raw body nor the whole roster is held in memory
+    rows = _iter_course_list_rows(file, ["matriculation_number", "name", "ca_mark"])
+    # File reads and Arrow parsing are blocking, so each chunk is pulled on a worker thread
+    while chunk := await to_thread.run_sync(_take, rows, IN_CHUNK_SIZE):
+        # Resolve the chunk's matriculation numbers in one IN query instead of a SELECT per row
+        existing = set((await db.execute(select(Student.matriculation_number).where(
+            Student.matriculation_number.in_({matric for matric, _ in chunk if matric})
+        ))).scalars())
+        course_lists = [
+            {
+                "course_id": course_id,
+                "matriculation_number": matric,
+                "ca_mark": ca_mark
+            }
+            for matric, ca_mark in chunk
+            if matric in existing
+        ]
+        logger.debug("Course list rows to insert: %d of %d", len(course_lists), len(chunk))
+        if course_lists:
+            yield course_lists
 
-# def parse_course_list_csv(content, course_id, db):
-#     df = pd.read_csv(io.BytesIO(content))
-#     required_columns = ["matriculation_number", "name", "ca_mark"]
-#     if not all(col in df.columns for col in required_columns):
-#         raise HTTPException(status_code=400, detail="CSV missing required columns")
-    
-#     course_lists = []
-#     for _, row in df.iterrows():
-#         student = db.query(Student).filter(Student.matriculation_number == row["matriculation_number"]).first()
-#         if student:
-#             course_lists.append({
-#                 "course_id": course_id,
-#                 "matriculation_number": row["matriculation_number"],
-#                 "ca_mark": float(row["ca_mark"]) if pd.notna(row["ca_mark"]) else None
-#             })
-#     return course_lists
\ No newline at end of file
+async def insert_course_lists(db, course_lists):
+    if engine.dialect.name != "postgresql":
+        await db.execute(insert(CourseList), course_lists)  # one executemany instead of an ORM add per row
+        return
+    # COPY FROM STDIN skips per-row statement parsing and planning; it runs on the session's own
+    # connection, so it commits or rolls back with the rest of the upload
+    conn = await (await db.connection()).get_raw_connection()
+    await conn.driver_connection.copy_records_to_table(
+        CourseList.__tablename__,
+        records=[(cl["course_id"], cl["matriculation_number"], cl["ca_mark"]) for cl in course_lists],
+        columns=["course_id", "matriculation_number", "ca_mark"]
+    )
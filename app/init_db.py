@@ -0,0 +1,14 @@
+import asyncio
+
+from app.models import engine, create_schema
+
+# One-off schema setup for deployments that run with DB_AUTO_CREATE=false:
+#   python -m app.init_db
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(create_schema)
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(init_db())
@@ -1,49 +1,314 @@
 
 
+import asyncio
 import base64
-from fastapi import FastAPI, Depends, Form, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
-import pytz
-from sqlalchemy.orm import Session
-from datetime import datetime
-import io
-import pandas as pd
+import hashlib
+from fastapi import FastAPI, Body, Depends, Form, Header, HTTPException, Query, Request, UploadFile, File
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
+from sqlalchemy import JSON, DateTime, and_, bindparam, delete, exists, func, insert, literal, select
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+import os
 import logging
 
 import uvicorn
-from app.models import get_db, Admin, Student, Department, Level, Course, CourseList, ExamSession, Attendance, ErrorLog, Base, engine
+from app.config import DB_AUTO_CREATE, LOG_LEVEL
+from app.models import get_db, SessionLocal, Admin, Student, Department, Level, Course, CourseList, ExamSession, Attendance, ErrorLog, engine, create_schema, utcnow, warm_pool, ATTENDANCE_LOCK_NAMESPACE, SESSION_LOCK_NAMESPACE
 from app.models import AdminLogin, AdminSignup, StudentCreate, EnrollmentStatusRequest, ExamSessionCreate, StudentAuthRequest, CAMarkDisputeRequest, AttendanceReportRequest, ErrorReportRequest
-from app.security import verify_password, create_access_token, get_current_admin, get_password_hash
-from app.csv_handler import generate_enrollment_list_csv, parse_course_list_csv
+from app.security import burn_password_check, check_password, create_access_token, get_current_admin, hash_password
+from app.csv_handler import enrollment_list_version, generate_enrollment_list_csv, generate_attendance_report, generate_error_report, attendance_report_version, error_report_version, parse_course_list_csv, insert_course_lists, CSV_CHUNK_ROWS, REPORT_MEDIA_TYPES
+from app.cache import get_admin_by_username, get_course_by_code, get_course_by_id, get_department_by_id, get_level_by_id, report_cache_path, cache_report, open_cached_report, invalidate_reports
 from app.models import EnrollmentRequest
 
-logging.basicConfig(level=logging.DEBUG)
-
-app = FastAPI(title="Authentikate UBa Biometric Exam Attendance System")
-
-# Create database tables
-Base.metadata.create_all(bind=engine)
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+logging.basicConfig(level=LOG_LEVEL)
+
+WAT_TZ = timezone(timedelta(hours=1), "WAT")  # Africa/Lagos: fixed UTC+1, no DST; session times are stored as naive WAT
+
+def wat_now():
+    return datetime.now(WAT_TZ).replace(tzinfo=None)  # session times are naive WAT
+
+SESSION_PURGE_INTERVAL = 300  # seconds between expired-session purges
+
+async def purge_expired_sessions():
+    now = wat_now()
+    async with SessionLocal() as db:
+        # Sessions with attendance or error logs are kept: their reports stay available and the FKs stay valid
+        await db.execute(delete(ExamSession).where(
+            ExamSession.end_time < now,
+            ~exists().where(Attendance.session_id == ExamSession.session_id),
+            ~exists().where(ErrorLog.session_id == ExamSession.session_id)
+        ))
+        await db.commit()
+
+async def purge_expired_sessions_periodically():
+    while True:
+        await asyncio.sleep(SESSION_PURGE_INTERVAL)
+        try:
+            await purge_expired_sessions()
+        except Exception as e:
+            logging.error("Session purge error: %s", e)
+
+ERROR_LOG_FLUSH_INTERVAL = 0.05  # seconds between batched error log writes
+ERROR_LOG_BATCH_SIZE = 500  # most error logs written per insert
+ERROR_LOG_QUEUE_SIZE = 10000  # beyond this, new error logs are dropped rather than grow memory unbounded
+ERROR_LOG_RETRY_INTERVAL = 5  # seconds to wait after a failed flush before trying the database again
+
+# Authentication failures are queued and written in batches, keeping the commit off the request path
+error_log_queue = asyncio.Queue(maxsize=ERROR_LOG_QUEUE_SIZE)
+
+def queue_error_log(session_id, matriculation_number, error_type, details):
+    error_log = {
+        "session_id": session_id,
+        "matriculation_number": matriculation_number,
+        "error_type": error_type,
+        "details": details,
+        "timestamp": utcnow()
+    }
+    try:
+        error_log_queue.put_nowait(error_log)
+    except asyncio.QueueFull:
+        logging.warning("Error log queue full, dropping: %s", error_log)
+
+async def write_error_logs(error_logs):
+    async with SessionLocal() as db:
+        await db.execute(insert(ErrorLog), error_logs)
+        await db.commit()
+
+def is_transient_db_error(e):
+    # The database couldn't be reached (connection refused or lost, pool timeout), as opposed to rejecting the data
+    if isinstance(e, DBAPIError) and e.connection_invalidated:
+        return True
+    return isinstance(e, (OperationalError, PoolTimeoutError, OSError))
+
+def requeue_error_logs(error_logs):
+    for error_log in error_logs:
+        try:
+            error_log_queue.put_nowait(error_log)
+        except asyncio.QueueFull:
+            logging.warning("Error log queue full, dropping: %s", error_log)
+
+def invalidate_error_reports(error_logs):
+    try:
+        for session_id in {error_log["session_id"] for error_log in error_logs}:
+            invalidate_reports(session_id, "error")
+    except OSError as e:
+        logging.error("Error report cache invalidation failed: %s", e)
+
+async def flush_error_log_batch():
+    error_logs = []
+    while not error_log_queue.empty() and len(error_logs) < ERROR_LOG_BATCH_SIZE:
+        error_logs.append(error_log_queue.get_nowait())
+    if not error_logs:
+        return
+    try:
+        await write_error_logs(error_logs)
+    except Exception as e:
+        if is_transient_db_error(e):
+            # Nothing is wrong with the rows: keep them for the next periodic flush
+            requeue_error_logs(error_logs)
+            raise
+        # One bad row (e.g. an FK violation) fails the whole batch; retry row by row so only it is lost
+        logging.warning("Error log batch failed, retrying %d entries individually: %s", len(error_logs), e)
+        written = []
+        for i, error_log in enumerate(error_logs):
+            try:
+                await write_error_logs([error_log])
+                written.append(error_log)
+            except Exception as e:
+                if is_transient_db_error(e):
+                    requeue_error_logs(error_logs[i:])
+                    invalidate_error_reports(written)
+                    raise
+                logging.error("Error log dropped: %s (%s)", e, error_log)
+        error_logs = written
+    invalidate_error_reports(error_logs)
+
+async def flush_error_logs():
+    while not error_log_queue.empty():
+        await flush_error_log_batch()
+
+async def flush_error_logs_periodically():
+    while True:
+        await asyncio.sleep(ERROR_LOG_FLUSH_INTERVAL)
+        try:
+            await flush_error_logs()
+        except Exception as e:
+            logging.error("Error log flush error: %s", e)
+            await asyncio.sleep(ERROR_LOG_RETRY_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create database tables (async engines cannot run DDL at import time); turn off once the schema is managed elsewhere
+    if DB_AUTO_CREATE:
+        async with engine.begin() as conn:
+            await conn.run_sync(create_schema)
+    await warm_pool()
+    purge_task = asyncio.create_task(purge_expired_sessions_periodically())
+    error_log_task = asyncio.create_task(flush_error_logs_periodically())
+    yield
+    purge_task.cancel()
+    error_log_task.cancel()
+    try:
+        await flush_error_logs()  # don't lose errors queued just before shutdown
+    except Exception as e:
+        logging.error("Error logs lost on shutdown: %s", e)
+    await engine.dispose()
+
+# Parquet and Feather reports are already compressed; gzipping them again only burns CPU
+UNCOMPRESSED_MEDIA_TYPES = {REPORT_MEDIA_TYPES["parquet"], REPORT_MEDIA_TYPES["feather"]}
+
+class ReportGZipResponder(GZipResponder):
+    async def send_with_gzip(self, message):
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            # Pass these through untouched, the same way responses with their own Content-Encoding are
+            media_type = Headers(raw=message["headers"]).get("content-type", "").split(";")[0]
+            if media_type in UNCOMPRESSED_MEDIA_TYPES:
+                self.content_encoding_set = True
+
+class ReportGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = ReportGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+app = FastAPI(
+    title="Authentikate UBa Biometric Exam Attendance System",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # orjson also serializes datetimes natively
+)
+# Compress streamed CSV reports (and large JSON) chunk by chunk for clients that accept gzip
+app.add_middleware(ReportGZipMiddleware, minimum_size=1024, compresslevel=1)
+
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    # Handlers without their own try/except let HTTPException through untouched; anything else ends up here
+    logging.exception("Unhandled error on %s", request.url.path)
+    return ORJSONResponse(status_code=500, content={"detail": "Internal server error"})
+
+def _enrolled_courses_json():
+    if engine.dialect.name == "postgresql":
+        course_json = func.json_agg(func.json_build_object(
+            "course_code", Course.course_code, "course_name", Course.course_name, "ca_mark", CourseList.ca_mark
+        ), type_=JSON)
+    else:
+        course_json = func.json_group_array(func.json_object(
+            "course_code", Course.course_code, "course_name", Course.course_name, "ca_mark", CourseList.ca_mark
+        ), type_=JSON)
+    return select(course_json).select_from(CourseList).join(
+        Course, CourseList.course_id == Course.course_id
+    ).where(CourseList.matriculation_number == Student.matriculation_number).scalar_subquery()
+
+# Statements for the two fingerprint endpoints are built once; only the bound values change per request
+ENROLLMENT_STATUS_LOOKUP = select(Student, _enrolled_courses_json()).where(
+    Student.fingerprint_template == bindparam("fingerprint_template")
+)
+
+# The photo itself is not loaded: the response links to /students/{matric}/photo instead of inlining it
+AUTHENTICATE_LOOKUP = select(
+    ExamSession, Student, CourseList, Course, Student.photo.isnot(None).label("has_photo")
+).select_from(ExamSession).outerjoin(
+    Student, Student.fingerprint_template == bindparam("fingerprint_template")
+).outerjoin(
+    CourseList, and_(
+        CourseList.matriculation_number == Student.matriculation_number,
+        CourseList.course_id == ExamSession.course_id
+    )
+).outerjoin(
+    Course, Course.course_id == CourseList.course_id
+).where(ExamSession.session_id == bindparam("session_id")).options(defer(Student.photo))
+
+def photo_url(matriculation_number, has_photo):
+    return f"/students/{matriculation_number}/photo" if has_photo else None
+
+def photo_media_type(photo_bytes):
+    if photo_bytes.startswith(b"\x89PNG"):
+        return "image/png"
+    if photo_bytes.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    return "application/octet-stream"
+
+def to_naive_wat(dt):
+    # Aware datetimes are converted to WAT; naive ones are assumed to already be WAT
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(WAT_TZ).replace(tzinfo=None)
+
+def make_etag(version_key):
+    return '"' + hashlib.blake2b(version_key.encode(), digest_size=16).hexdigest() + '"'
+
+def etag_matches(etag, if_none_match):
+    # If-None-Match uses weak comparison: a W/ prefix is ignored, and * matches any current representation
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+async def stream_report(session_id, admin, db, kind, report_format, if_none_match, version, generate):
+    # Shared by the report endpoints: session ownership, ETag short-circuit, on-disk cache and streaming.
+    # version(session) returns the report's version row; generate(session, report_format) its byte stream.
+    if report_format not in REPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported report format: {report_format}")
+    session = (await db.execute(select(ExamSession).where(ExamSession.session_id == session_id))).scalars().first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if session.admin_id != admin.admin_id:
+        raise HTTPException(status_code=403, detail="Not authorized for this session")
+
+    # The ETag is derived from the report's version, so unchanged reports cost one small query and a 304.
+    # CSV reports of ended sessions are served from the on-disk cache, filling it on the first download.
+    media_type = REPORT_MEDIA_TYPES[report_format]
+    ended = session.end_time < wat_now()
+    etag = make_etag(f"{kind}:{session.session_id}:{report_format}:{tuple(await version(session))}")
+    cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=60" if ended else "private, no-cache"}
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=cache_headers)
+    headers = {
+        "Content-Disposition": f"attachment; filename={kind}_report_{session.session_id}.{report_format}",
+        **cache_headers
+    }
+    if report_format != "csv" or not ended:
+        logging.debug("%s report generated for session %s", kind.capitalize(), session_id)
+        return StreamingResponse(generate(session, report_format), media_type=media_type, headers=headers)
+    path = report_cache_path(session.session_id, kind, etag.strip('"'))
+    cached = open_cached_report(path)
+    if cached is None:
+        logging.debug("%s report generated for session %s", kind.capitalize(), session_id)
+        return StreamingResponse(cache_report(generate(session, report_format), path), media_type=media_type, headers=headers)
+    size, chunks = cached
+    return StreamingResponse(chunks, media_type=media_type, headers={**headers, "Content-Length": str(size)})
 
 @app.post("/auth/signup")
-async def signup(admin: AdminSignup, db: Session = Depends(get_db)):
+async def signup(admin: AdminSignup, db: AsyncSession = Depends(get_db)):
     try:
-        department = db.query(Department).filter(Department.department_id == admin.department_id).first()
+        department = await get_department_by_id(db, admin.department_id)
         if not department:
             raise HTTPException(status_code=400, detail="Invalid department")
-        existing_admin = db.query(Admin).filter(Admin.username == admin.username).first()
+        existing_admin = (await db.execute(select(Admin).where(Admin.username == admin.username))).scalars().first()
         if existing_admin:
             raise HTTPException(status_code=400, detail="Username already exists")
         db_admin = Admin(
             username=admin.username,
-            password_hash=get_password_hash(admin.password),
+            password_hash=await hash_password(admin.password),
             department_id=admin.department_id
         )
         db.add(db_admin)
-        db.commit()
-        logging.debug(f"Admin registered: {admin.username}")
+        await db.commit()
+        logging.debug("Admin registered: %s", admin.username)
         token = create_access_token({"sub": admin.username})  # Generate token
         return {
             "message": "Admin registered successfully",
@@ -51,20 +316,24 @@ async def signup(admin: AdminSignup, db: Session = Depends(get_db)):
             "token_type": "bearer"
         }
     except Exception as e:
-        db.rollback()
-        logging.error(f"Signup error: {str(e)}")
+        await db.rollback()
+        logging.error("Signup error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 
 
 @app.post("/auth/login")
-async def login(admin: AdminLogin, db: Session = Depends(get_db)):
-    db_admin = db.query(Admin).filter(Admin.username == admin.username).first()
-    if not db_admin or not verify_password(admin.password, db_admin.password_hash):
+async def login(admin: AdminLogin, db: AsyncSession = Depends(get_db)):
+    db_admin = await get_admin_by_username(db, admin.username)
+    # bcrypt takes ~100 ms of CPU, so it runs on a bounded thread limiter rather than the event loop
+    if not db_admin:
+        await burn_password_check(admin.password)
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if not await check_password(admin.password, db_admin.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     token = create_access_token({"sub": admin.username})
-    logging.debug(f"Admin logged in: {admin.username}")
+    logging.debug("Admin logged in: %s", admin.username)
     return {
         "access_token": token,
         "token_type": "bearer",
@@ -76,29 +345,32 @@ async def login(admin: AdminLogin, db: Session = Depends(get_db)):
 
 
 @app.post("/enrollment/status")
-async def enrollment_status(request: EnrollmentStatusRequest, db: Session = Depends(get_db)):
+async def enrollment_status(request: EnrollmentStatusRequest, db: AsyncSession = Depends(get_db)):
     try:
-        student = db.query(Student).filter(Student.fingerprint_template == request.fingerprint_template).first()
-        if not student:
+        # Student and enrolled courses in one round trip; courses come back as one JSON array so the photo isn't repeated per course
+        row = (await db.execute(ENROLLMENT_STATUS_LOOKUP, {"fingerprint_template": request.fingerprint_template})).first()
+        if not row:
             raise HTTPException(status_code=404, detail="Student not found")
-        enrolled_courses = db.query(CourseList, Course).join(Course, CourseList.course_id == Course.course_id).filter(
-            CourseList.matriculation_number == student.matriculation_number
-        ).all()
+        student, enrolled_courses = row
         course_info = [
-            {"course_code": course.course_code, "course_name": course.course_name, "ca_mark": cl.ca_mark}
-            for cl, course in enrolled_courses
+            {
+                "course_code": course["course_code"],
+                "course_name": course["course_name"],
+                "ca_mark": None if course["ca_mark"] is None else float(course["ca_mark"])
+            }
+            for course in enrolled_courses or []
         ]
-        logging.debug(f"Enrollment status for {student.matriculation_number}: {course_info}")
+        logging.debug("Enrollment status for %s: %s", student.matriculation_number, course_info)
         return {
             "matriculation_number": student.matriculation_number,
             "name": student.name,
             "department_id": student.department_id,
             "level_id": student.level_id,
-            "photo": student.photo,  # Return base64 string
+            "photo": student.photo,  # Return base64 string; this endpoint is unauthenticated, so it can't link to the photo endpoint
             "enrolled_courses": course_info
         }
     except Exception as e:
-        logging.error(f"Status error: {str(e)}")
+        logging.error("Status error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     
 
@@ -111,14 +383,14 @@ async def enroll_student(
     fingerprint_template: str = Form(...),
     photo: UploadFile = File(None),
     admin=Depends(get_current_admin),
-    db: Session = Depends(get_db) 
+    db: AsyncSession = Depends(get_db) 
 ):
     try:
-        logging.debug(f"Received form data: matric={matriculation_number}, name={name}, dept={department_id}, level={level_id}, fingerprint={fingerprint_template}")
+        logging.debug("Received form data: matric=%s, name=%s, dept=%s, level=%s, fingerprint=%s", matriculation_number, name, department_id, level_id, fingerprint_template)
         
-        department = db.query(Department).filter(Department.department_id == department_id).first()
-        level = db.query(Level).filter(Level.level_id == level_id, Level.department_id == department_id).first()
-        if not department or not level:
+        department = await get_department_by_id(db, department_id)
+        level = await get_level_by_id(db, level_id)
+        if not department or not level or level.department_id != department_id:
             raise HTTPException(status_code=400, detail="Invalid department or level")
         if department.department_id != admin.department_id:
             raise HTTPException(status_code=403, detail="Not authorized for this department")
@@ -138,59 +410,111 @@ async def enroll_student(
             photo=photo_data
         )
         db.add(db_student)
-        db.commit()
-        logging.debug(f"Student enrolled: {matriculation_number}")
+        await db.commit()
+        logging.debug("Student enrolled: %s", matriculation_number)
         return {"message": "Student enrolled successfully", "student_id": db_student.matriculation_number}
     except Exception as e:
-        db.rollback()
-        logging.error(f"Enrollment error: {str(e)}")
+        await db.rollback()
+        logging.error("Enrollment error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
+ENROLL_BATCH_MAX_STUDENTS = 1000  # the batch is one executemany in one transaction, so keep it bounded
 
-
-
-
-
+@app.post("/enrollment/enroll_batch")
+async def enroll_students(students: List[StudentCreate] = Body(..., max_length=ENROLL_BATCH_MAX_STUDENTS), admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    # Enrolls a whole class in one request and one transaction; photos are base64 strings as in StudentCreate
+    try:
+        if not students:
+            raise HTTPException(status_code=400, detail="No students provided")
+        # Validate each distinct (department, level) pair once, from the lookup caches
+        for department_id, level_id in {(s.department_id, s.level_id) for s in students}:
+            department = await get_department_by_id(db, department_id)
+            level = await get_level_by_id(db, level_id)
+            if not department or not level or level.department_id != department_id:
+                raise HTTPException(status_code=400, detail="Invalid department or level")
+            if department.department_id != admin.department_id:
+                raise HTTPException(status_code=403, detail="Not authorized for this department")
+        await db.execute(insert(Student), [s.model_dump() for s in students])  # one executemany for the batch
+        await db.commit()
+        logging.debug("Students enrolled: %d", len(students))
+        return {"message": "Students enrolled successfully", "count": len(students)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        logging.error("Batch enrollment error: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/enrollment/list/{department_id}/{level_id}")
-async def download_enrollment_list(department_id: int, level_id: int, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
+async def download_enrollment_list(department_id: int, level_id: int, if_none_match: Optional[str] = Header(None), admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     try:
         if admin.department_id != department_id:
             raise HTTPException(status_code=403, detail="Not authorized for this department")
-        students = db.query(Student).filter(
-            Student.department_id == department_id,
-            Student.level_id == level_id
-        ).all()
-        csv_content = generate_enrollment_list_csv(students, department_id, level_id)
-        logging.debug(f"Enrollment list generated for dept {department_id}, level {level_id}")
+        # One aggregate both checks the list is non-empty and versions it, so an unchanged list is a 304
+        version = tuple(await enrollment_list_version(db, department_id, level_id))
+        if not version[0]:
+            raise HTTPException(status_code=404, detail="No students found")
+        etag = make_etag(f"enrollment:{department_id}:{level_id}:{version}")
+        cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(etag, if_none_match):
+            return Response(status_code=304, headers=cache_headers)
+        logging.debug("Enrollment list generated for dept %s, level %s", department_id, level_id)
         return StreamingResponse(
-            io.BytesIO(csv_content.encode('utf-8')),
+            generate_enrollment_list_csv(department_id, level_id),
             media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename=enrollment_list_{department_id}_{level_id}.csv"}
+            headers={
+                "Content-Disposition": f"attachment; filename=enrollment_list_{department_id}_{level_id}.csv",
+                **cache_headers
+            }
+        )
+    except Exception as e:
+        logging.error("List error: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/students/{matriculation_number}/photo")
+async def get_student_photo(matriculation_number: str, admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    # Raw image bytes, so clients can fetch and cache the photo instead of decoding base64 from JSON
+    try:
+        row = (await db.execute(select(Student.photo, Student.department_id).where(Student.matriculation_number == matriculation_number))).first()
+        if not row or not row.photo:
+            raise HTTPException(status_code=404, detail="Photo not found")
+        photo, department_id = row
+        if department_id != admin.department_id:
+            raise HTTPException(status_code=403, detail="Not authorized for this department")
+        photo_bytes = base64.b64decode(photo)
+        return Response(
+            content=photo_bytes,
+            media_type=photo_media_type(photo_bytes),
+            headers={"Cache-Control": "private, max-age=86400"}
         )
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"List error: {str(e)}")
+        logging.error("Photo error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/course/upload")
-async def upload_course_list(course_id: int, file: UploadFile = File(...), admin=Depends(get_current_admin), db: Session = Depends(get_db)):
+async def upload_course_list(course_id: int, file: UploadFile = File(...), admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     try:
-        course = db.query(Course).filter(Course.course_id == course_id).first()
+        course = await get_course_by_id(db, course_id)
         if not course:
             raise HTTPException(status_code=404, detail="Course not found")
         if course.department_id != admin.department_id:
             raise HTTPException(status_code=403, detail="Not authorized for this department")
-        content = await file.read()
-        course_lists = parse_course_list_csv(content, course_id, db)
-        for cl in course_lists:
-            db_cl = CourseList(**cl)
-            db.add(db_cl)
-        db.commit()
-        logging.debug(f"Course list uploaded for course {course_id}")
+        async for course_lists in parse_course_list_csv(file.file, course_id, db):
+            # Re-uploads replace a student's previous row for this course instead of duplicating it
+            await db.execute(delete(CourseList).where(
+                CourseList.course_id == course_id,
+                CourseList.matriculation_number.in_({cl["matriculation_number"] for cl in course_lists})
+            ))
+            await insert_course_lists(db, course_lists)
+        await db.commit()
+        invalidate_reports(kind="attendance")  # rosters changed; rare enough to drop every cached attendance report
+        logging.debug("Course list uploaded for course %s", course_id)
         return {"message": "Course list uploaded successfully"}
     except Exception as e:
-        db.rollback()
-        logging.error(f"Upload error: {str(e)}")
+        await db.rollback()
+        logging.error("Upload error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     
 
@@ -198,248 +522,227 @@ async def upload_course_list(course_id: int, file: UploadFile = File(...), admin
 
 
 @app.post("/session/")
-async def create_session(session: ExamSessionCreate, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
+async def create_session(session: ExamSessionCreate, admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     try:
         # Validate course by code
-        course = db.query(Course).filter(Course.course_code == session.course_code).first()
+        course = await get_course_by_code(db, session.course_code)
         if not course:
             raise HTTPException(status_code=404, detail="Course not found")
         if course.department_id != admin.department_id:
             raise HTTPException(status_code=403, detail="Not authorized for this department")
 
-        # Check for overlapping sessions
-        overlapping_session = db.query(ExamSession).filter(
+        # Session times are stored as naive WAT (asyncpg rejects aware values for these columns)
+        start_time = to_naive_wat(session.start_time)
+        end_time = to_naive_wat(session.end_time)
+
+        if engine.dialect.name == "postgresql":
+            # Serialize session creation per course until commit, so two concurrent requests can't both pass the overlap check
+            await db.execute(select(func.pg_advisory_xact_lock(SESSION_LOCK_NAMESPACE, course.course_id)))
+
+        # Insert only if no session for this course overlaps, checked and written in one statement
+        overlapping = select(ExamSession.session_id).where(
             ExamSession.course_id == course.course_id,
-            ExamSession.start_time <= session.end_time,
-            ExamSession.end_time >= session.start_time
-        ).first()
-        if overlapping_session:
+            ExamSession.start_time <= end_time,
+            ExamSession.end_time >= start_time
+        ).exists()
+        session_id = (await db.execute(
+            insert(ExamSession.__table__).from_select(
+                ["course_id", "admin_id", "start_time", "end_time"],
+                select(
+                    literal(course.course_id),
+                    literal(admin.admin_id),
+                    literal(start_time, DateTime),
+                    literal(end_time, DateTime)
+                ).where(~overlapping)
+            ).returning(ExamSession.__table__.c.session_id)
+        )).scalar()
+        if session_id is None:
             raise HTTPException(status_code=400, detail="Session overlaps with existing session for this course")
-
-        db_session = ExamSession(
-            course_id=course.course_id,
-            admin_id=admin.admin_id,
-            start_time=session.start_time,
-            end_time=session.end_time
-        )
-        db.add(db_session)
-        db.commit()
-        logging.debug(f"Session created: {db_session.session_id}")
-        return {"message": "Session created successfully", "session_id": db_session.session_id}
+        await db.commit()
+        logging.debug("Session created: %s", session_id)
+        return {"message": "Session created successfully", "session_id": session_id}
     except Exception as e:
-        db.rollback()
-        logging.error(f"Session error: {str(e)}")
+        await db.rollback()
+        logging.error("Session error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     
 
 
 @app.get("/departments")
-async def get_departments(db: Session = Depends(get_db)):
+async def get_departments(db: AsyncSession = Depends(get_db)):
     try:
-        depts = db.query(Department).all()  # Fetch all departments, not just for the admin
-        return [{"department_id": d.department_id, "name": d.name} for d in depts]
+        depts = (await db.execute(select(Department.department_id, Department.name))).all()  # Fetch all departments, not just for the admin
+        return [{"department_id": department_id, "name": name} for department_id, name in depts]
     except Exception as e:
-        logging.error(f"Departments fetch error: {str(e)}")
+        logging.error("Departments fetch error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/levels")
-async def get_levels(admin=Depends(get_current_admin), db: Session = Depends(get_db)):
+async def get_levels(admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     try:
-        levels = db.query(Level).filter(Level.department_id == admin.department_id).all()
-        return [{"level_id": l.level_id, "name": l.name} for l in levels]
+        levels = (await db.execute(select(Level.level_id, Level.name).where(Level.department_id == admin.department_id))).all()
+        return [{"level_id": level_id, "name": name} for level_id, name in levels]
     except Exception as e:
-        logging.error(f"Levels fetch error: {str(e)}")
+        logging.error("Levels fetch error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/courses")
-async def get_courses(admin=Depends(get_current_admin), db: Session = Depends(get_db)):
-    try:
-        courses = db.query(Course).filter(Course.department_id == admin.department_id).all()
-        return [{"course_id": c.course_id, "course_code": c.course_code, "course_name": c.course_name} for c in courses]
-    except Exception as e:
-        logging.error(f"Courses fetch error: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
-
-
-    
-@app.get("/sessions")
-async def get_sessions(admin_id: int, db: Session = Depends(get_db), admin=Depends(get_current_admin)):
+async def get_courses(admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     try:
-        # Fetch sessions where the admin is the creator
-        sessions = db.query(ExamSession).filter(ExamSession.admin_id == admin.admin_id).all()
-        if not sessions:
-            raise HTTPException(status_code=404, detail="No sessions found for this admin")
-
-        # Convert to response format
+        courses = (await db.execute(select(Course.course_id, Course.course_code, Course.course_name).where(
+            Course.department_id == admin.department_id
+        ))).all()
         return [
-            {
-                "session_id": session.session_id,
-                "course_code": db.query(Course).filter(Course.course_id == session.course_id).first().course_code,
-                "start_time": session.start_time.isoformat(),
-                "end_time": session.end_time.isoformat()
-            }
-            for session in sessions
+            {"course_id": course_id, "course_code": course_code, "course_name": course_name}
+            for course_id, course_code, course_name in courses
         ]
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error fetching sessions: {str(e)}")
-
-
+        logging.error("Courses fetch error: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
 
 
+    
 @app.post("/attendance/authenticate")
-async def authenticate_student(auth: StudentAuthRequest, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
+async def authenticate_student(auth: StudentAuthRequest, admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     try:
+        # Session, fingerprint match, enrollment and course in one query. Outer joins keep the session row
+        # when no student matches or the student is not enrolled, so each failure is still reported separately.
+        row = (await db.execute(AUTHENTICATE_LOOKUP, {
+            "session_id": auth.session_id,
+            "fingerprint_template": auth.fingerprint_template
+        })).first()
+
         # Validate session
-        session = db.query(ExamSession).filter(ExamSession.session_id == auth.session_id).first()
-        if not session:
+        if not row:
             raise HTTPException(status_code=404, detail="Session not found")
+        session, student, course_list, course, has_photo = row
         if session.admin_id != admin.admin_id:
             raise HTTPException(status_code=403, detail="Not authorized for this session")
 
         # Check time window in WAT
-        wat_tz = pytz.timezone('Africa/Lagos')  # WAT (UTC+1)
-        now = datetime.now(wat_tz).replace(tzinfo=None)  # Make naive
-        logging.debug(f"Current WAT time: {now}, Session start: {session.start_time}, end: {session.end_time}")
+        now = wat_now()
+        logging.debug("Current WAT time: %s, Session start: %s, end: %s", now, session.start_time, session.end_time)
 
         # start_time and end_time are naive (from TIMESTAMP WITHOUT TIME ZONE)
-        start_time = session.start_time
-        end_time = session.end_time
-
-        if now < start_time or now > end_time:
+        if not session.start_time <= now <= session.end_time:
             raise HTTPException(status_code=403, detail="Authentication outside session time window")
 
-        # Match fingerprint
-        student = db.query(Student).filter(Student.fingerprint_template == auth.fingerprint_template).first()
         if not student:
-            error_log = ErrorLog(
-                session_id=auth.session_id,
-                matriculation_number=None,
-                error_type="AUTH_FAILED",
-                details="No student matched the provided fingerprint"
-            )
-            db.add(error_log)
-            db.commit()
-            logging.error(f"Fingerprint mismatch for session {auth.session_id}")
+            queue_error_log(auth.session_id, None, "AUTH_FAILED", "No student matched the provided fingerprint")
+            logging.error("Fingerprint mismatch for session %s", auth.session_id)
             raise HTTPException(status_code=404, detail="Student not found")
 
         # Check course enrollment
-        course_list = db.query(CourseList).filter(
-            CourseList.course_id == session.course_id,
-            CourseList.matriculation_number == student.matriculation_number
-        ).first()
         if not course_list:
-            error_log = ErrorLog(
-                session_id=auth.session_id,
-                matriculation_number=student.matriculation_number,
-                error_type="NOT_ENROLLED",
-                details=f"Student not enrolled in course {session.course_id}"
-            )
-            db.add(error_log)
-            db.commit()
-            logging.error(f"Student {student.matriculation_number} not enrolled in course {session.course_id}")
+            queue_error_log(auth.session_id, student.matriculation_number, "NOT_ENROLLED", f"Student not enrolled in course {session.course_id}")
+            logging.error("Student %s not enrolled in course %s", student.matriculation_number, session.course_id)
             raise HTTPException(status_code=403, detail="Student not enrolled in this course")
 
         # Validate CA mark
         if course_list.ca_mark is None or course_list.ca_mark < 0:
-            error_log = ErrorLog(
-                session_id=auth.session_id,
-                matriculation_number=student.matriculation_number,
-                error_type="INVALID_CA_MARK",
-                details=f"Invalid CA mark: {course_list.ca_mark}"
-            )
-            db.add(error_log)
-            db.commit()
-            logging.error(f"Invalid CA mark for {student.matriculation_number}: {course_list.ca_mark}")
+            queue_error_log(auth.session_id, student.matriculation_number, "INVALID_CA_MARK", f"Invalid CA mark: {course_list.ca_mark}")
+            logging.error("Invalid CA mark for %s: %s", student.matriculation_number, course_list.ca_mark)
             raise HTTPException(status_code=403, detail="Invalid CA mark")
 
-        # Get course name
-        course = db.query(Course).filter(Course.course_id == session.course_id).first()
+        # Course name comes from the joined row
         if not course:
             raise HTTPException(status_code=404, detail="Course not found")
 
-        # Check if already authenticated
-        existing_attendance = db.query(Attendance).filter(
+        if engine.dialect.name == "postgresql":
+            # Under READ COMMITTED two concurrent scans could both pass the NOT EXISTS check below,
+            # so serialize them per (session, student) until commit; hash collisions only add waiting
+            await db.execute(select(func.pg_advisory_xact_lock(
+                ATTENDANCE_LOCK_NAMESPACE, func.hashtext(f"{auth.session_id}:{student.matriculation_number}")
+            )))
+
+        # Record attendance unless an authenticated row already exists, checked and written in one statement
+        already_authenticated = select(Attendance.id).where(
             Attendance.session_id == auth.session_id,
-            Attendance.matriculation_number == student.matriculation_number
-        ).first()
-        if existing_attendance and existing_attendance.authenticated:
-            logging.debug(f"Student {student.matriculation_number} already authenticated for session {auth.session_id}")
+            Attendance.matriculation_number == student.matriculation_number,
+            Attendance.authenticated.is_(True)
+        ).exists()
+        attendance_id = (await db.execute(
+            insert(Attendance.__table__).from_select(
+                ["session_id", "matriculation_number", "authenticated", "timestamp"],
+                select(
+                    literal(auth.session_id),
+                    literal(student.matriculation_number),
+                    literal(True),
+                    literal(utcnow(), DateTime)
+                ).where(~already_authenticated)
+            ).returning(Attendance.__table__.c.id)
+        )).scalar()
+        if attendance_id is None:
+            logging.debug("Student %s already authenticated for session %s", student.matriculation_number, auth.session_id)
             return {
                 "message": "Student already authenticated",
                 "matriculation_number": student.matriculation_number,
                 "name": student.name,
                 "ca_mark": course_list.ca_mark,
-                "photo": student.photo,
+                "photo_url": photo_url(student.matriculation_number, has_photo),
                 "course_name": course.course_name
             }
-
-        # Record attendance
-        attendance = Attendance(
-            session_id=auth.session_id,
-            matriculation_number=student.matriculation_number,
-            authenticated=True
-        )
-        db.add(attendance)
-        db.commit()
-        logging.debug(f"Student {student.matriculation_number} authenticated for session {auth.session_id}")
+        await db.commit()
+        invalidate_reports(auth.session_id, "attendance")
+        logging.debug("Student %s authenticated for session %s", student.matriculation_number, auth.session_id)
         return {
             "message": "Student authenticated successfully",
             "matriculation_number": student.matriculation_number,
             "name": student.name,
             "ca_mark": course_list.ca_mark,
-            "photo": student.photo,
+            "photo_url": photo_url(student.matriculation_number, has_photo),
             "course_name": course.course_name
         }
     except Exception as e:
-        db.rollback()
-        logging.error(f"Authentication error: {str(e)}")
+        await db.rollback()
+        logging.error("Authentication error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/sessions")
-async def get_sessions(admin_id: int, db: Session = Depends(get_db), admin=Depends(get_current_admin)):
+async def get_sessions(admin_id: int, db: AsyncSession = Depends(get_db), admin=Depends(get_current_admin)):
     try:
         if admin_id != admin.admin_id:
             raise HTTPException(status_code=403, detail="Not authorized to view sessions for this admin")
-        wat_tz = pytz.timezone('Africa/Lagos')
-        now = datetime.now(wat_tz).replace(tzinfo=None)
-        # Delete expired sessions
-        db.query(ExamSession).filter(ExamSession.end_time < now).delete()
-        db.commit()
-        sessions = db.query(ExamSession).filter(
+        now = wat_now()
+        sessions = (await db.execute(select(
+            ExamSession.session_id, Course.course_code, ExamSession.start_time, ExamSession.end_time
+        ).join(
+            Course, ExamSession.course_id == Course.course_id
+        ).where(
             ExamSession.admin_id == admin.admin_id,
             ExamSession.end_time >= now
-        ).all()
+        ))).all()
         if not sessions:
             return {"message": "No active sessions found for this admin"}
         return [
             {
-                "session_id": session.session_id,
-                "course_code": db.query(Course).filter(Course.course_id == session.course_id).first().course_code,
-                "start_time": session.start_time.isoformat(),
-                "end_time": session.end_time.isoformat()
+                "session_id": session_id,
+                "course_code": course_code,
+                "start_time": start_time,
+                "end_time": end_time
             }
-            for session in sessions
+            for session_id, course_code, start_time, end_time in sessions
         ]
     except Exception as e:
-        logging.error(f"Error fetching sessions: {str(e)}")
+        logging.error("Error fetching sessions: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/attendance/dispute")
-async def report_ca_mark_dispute(dispute: CAMarkDisputeRequest, db: Session = Depends(get_db)):
+async def report_ca_mark_dispute(dispute: CAMarkDisputeRequest, db: AsyncSession = Depends(get_db)):
     try:
         # Validate session and course
-        session = db.query(ExamSession).filter(ExamSession.session_id == dispute.session_id).first()
+        session = (await db.execute(select(ExamSession).where(ExamSession.session_id == dispute.session_id))).scalars().first()
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         if session.course_id != dispute.course_id:
             raise HTTPException(status_code=400, detail="Course does not match session")
 
         # Validate student
-        student = db.query(Student).filter(Student.matriculation_number == dispute.matriculation_number).first()
+        student = (await db.execute(select(Student.matriculation_number).where(Student.matriculation_number == dispute.matriculation_number))).scalar()
         if not student:
             raise HTTPException(status_code=404, detail="Student not found")
 
@@ -451,93 +754,39 @@ async def report_ca_mark_dispute(dispute: CAMarkDisputeRequest, db: Session = De
             details=dispute.details
         )
         db.add(error_log)
-        db.commit()
-        logging.debug(f"CA mark dispute logged for {dispute.matriculation_number} in session {dispute.session_id}")
+        await db.commit()
+        invalidate_reports(dispute.session_id, "error")
+        logging.debug("CA mark dispute logged for %s in session %s", dispute.matriculation_number, dispute.session_id)
         return {"message": "CA mark dispute logged successfully"}
     except Exception as e:
-        db.rollback()
-        logging.error(f"Dispute error: {str(e)}")
+        await db.rollback()
+        logging.error("Dispute error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/reports/attendance/{session_id}")
-async def get_attendance_report(session_id: int, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
-    try:
-        session = db.query(ExamSession).filter(ExamSession.session_id == session_id).first()
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-        if session.admin_id != admin.admin_id:
-            raise HTTPException(status_code=403, detail="Not authorized for this session")
-
-        attendance_records = db.query(Attendance, Student).join(
-            Student, Attendance.matriculation_number == Student.matriculation_number
-        ).filter(Attendance.session_id == session_id).all()
-
-        enrolled_students = db.query(CourseList, Student).join(
-            Student, CourseList.matriculation_number == Student.matriculation_number
-        ).filter(CourseList.course_id == session.course_id).all()
-
-        data = []
-        for a, s in attendance_records:
-            if a.authenticated:
-                data.append({
-                    "matriculation_number": s.matriculation_number,
-                    "name": s.name,
-                    "status": "Present",
-                    "timestamp": a.timestamp.isoformat()
-                })
-
-        enrolled_matrics = {s.matriculation_number for _, s in enrolled_students}
-        for _, s in enrolled_students:
-            if s.matriculation_number not in {a.matriculation_number for a, _ in attendance_records}:
-                data.append({
-                    "matriculation_number": s.matriculation_number,
-                    "name": s.name,
-                    "status": "Absent",
-                    "timestamp": None
-                })
-
-        df = pd.DataFrame(data)
-        stream = io.StringIO()
-        df.to_csv(stream, index=False)
-        logging.debug(f"Attendance report generated for session {session_id}")
-        return StreamingResponse(
-            io.BytesIO(stream.getvalue().encode('utf-8')),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename=attendance_report_{session_id}.csv"}
-        )
-    except Exception as e:
-        logging.error(f"Report error: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
+async def get_attendance_report(session_id: int, report_format: str = Query("csv", alias="format"), chunk_size: int = Query(CSV_CHUNK_ROWS, ge=100, le=50000), if_none_match: Optional[str] = Header(None), admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    return await stream_report(
+        session_id, admin, db, "attendance", report_format, if_none_match,
+        lambda session: attendance_report_version(db, session.session_id, session.course_id),
+        lambda session, fmt: generate_attendance_report(session.session_id, session.course_id, fmt, chunk_size)
+    )
 
 @app.get("/reports/errors/{session_id}")
-async def get_error_report(session_id: int, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
-    try:
-        session = db.query(ExamSession).filter(ExamSession.session_id == session_id).first()
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-        if session.admin_id != admin.admin_id:
-            raise HTTPException(status_code=403, detail="Not authorized for this session")
+async def get_error_report(session_id: int, report_format: str = Query("csv", alias="format"), chunk_size: int = Query(CSV_CHUNK_ROWS, ge=100, le=50000), if_none_match: Optional[str] = Header(None), admin=Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    return await stream_report(
+        session_id, admin, db, "error", report_format, if_none_match,
+        lambda session: error_report_version(db, session.session_id),
+        lambda session, fmt: generate_error_report(session.session_id, fmt, chunk_size)
+    )
 
-        error_logs = db.query(ErrorLog).filter(ErrorLog.session_id == session_id).all()
-        data = [
-            {
-                "matriculation_number": log.matriculation_number or "Unknown",
-                "error_type": log.error_type,
-                "details": log.details,
-                "timestamp": log.timestamp.isoformat()
-            }
-            for log in error_logs
-        ]
 
-        df = pd.DataFrame(data)
-        stream = io.StringIO()
-        df.to_csv(stream, index=False)
-        logging.debug(f"Error report generated for session {session_id}")
-        return StreamingResponse(
-            io.BytesIO(stream.getvalue().encode('utf-8')),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename=error_report_{session_id}.csv"}
-        ) 
-    except Exception as e:
-        logging.error(f"Error report error: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+if __name__ == "__main__":
+    # uvloop/httptools come with uvicorn[standard]; access logs cost a write per request
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        access_log=False
+    )
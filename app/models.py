@@ -1,24 +1,90 @@
 
 
+import asyncio
 from typing import Optional
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Index, event, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import deferred
+from sqlalchemy.pool import NullPool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from pydantic import BaseModel
-from datetime import datetime
-from app.config import DATABASE_URL
+from datetime import datetime, timezone
+from uuid import uuid4
+from app.config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_PGBOUNCER, DB_POOL_WARMUP
 
 # SQLAlchemy Setup
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine_options = {}
+if DB_PGBOUNCER:
+    # PgBouncer already pools connections, and in transaction mode a server connection can change between
+    # statements, so prepared statements cannot be cached client-side
+    engine_options = dict(
+        poolclass=NullPool,
+        connect_args={
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            # unique names so statements prepared on a shared server connection never collide
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        },
+    )
+elif not DATABASE_URL.startswith("sqlite"):
+    engine_options = dict(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=30,
+        pool_pre_ping=True,  # drop dead connections instead of failing the request
+        pool_recycle=1800,
+        # Keep every hot query shape prepared per connection so PostgreSQL skips parse/plan
+        connect_args={
+            "statement_cache_size": 1000,
+            "prepared_statement_cache_size": 500,
+            # JIT compilation costs more than these small OLTP queries take to run
+            "server_settings": {"application_name": "authentify", "jit": "off"},
+        },
+    )
+# Larger compiled-statement cache so every query shape (and the chunked IN variants) stays compiled
+engine = create_async_engine(DATABASE_URL, query_cache_size=1200, **engine_options)
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # Local/dev databases: WAL lets report reads run alongside writes, and NORMAL sync is safe under WAL
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def warm_pool():
+    # Open connections concurrently and hand them back to the pool, which keeps up to pool_size of them
+    if DB_PGBOUNCER or DATABASE_URL.startswith("sqlite"):
+        return
+    connections = await asyncio.gather(*(engine.connect() for _ in range(min(DB_POOL_WARMUP, DB_POOL_SIZE))))
+    for conn in connections:
+        await conn.close()
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+def utcnow():
+    # Naive UTC for the TIMESTAMP WITHOUT TIME ZONE columns (datetime.utcnow is deprecated)
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+SCHEMA_LOCK_ID = 72160412  # arbitrary advisory lock key shared by all workers
+SESSION_LOCK_NAMESPACE = 72160413  # first key of the per-course (namespace, course_id) session-creation lock
+ATTENDANCE_LOCK_NAMESPACE = 72160414  # first key of the per-(session, student) attendance lock
+
+def create_schema(conn):
+    if conn.dialect.name == "postgresql":
+        # One worker runs the DDL at a time; the others then find everything already created
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_ID})
+    Base.metadata.create_all(conn)
+    # create_all skips indexes on tables that already exist, so add any that are missing
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 # SQLAlchemy Models
 class University(Base):
@@ -42,14 +108,14 @@ class Level(Base):
     __tablename__ = "levels"
     level_id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    department_id = Column(Integer, ForeignKey("departments.department_id"))
+    department_id = Column(Integer, ForeignKey("departments.department_id"), index=True)  # /levels lists by department
 
 class Course(Base):
     __tablename__ = "courses"
     course_id = Column(Integer, primary_key=True)
     course_code = Column(String, unique=True, nullable=False)
     course_name = Column(String, nullable=False)
-    department_id = Column(Integer, ForeignKey("departments.department_id"))
+    department_id = Column(Integer, ForeignKey("departments.department_id"), index=True)  # /courses lists by department
     level_id = Column(Integer, ForeignKey("levels.level_id"))
 
 class Student(Base):
@@ -59,7 +125,14 @@ class Student(Base):
     department_id = Column(Integer, ForeignKey("departments.department_id"))
     level_id = Column(Integer, ForeignKey("levels.level_id"))
     photo = Column(String, nullable=True)
-    fingerprint_template = Column(String, nullable=False)
+    # Only ever compared in SQL, so loading a Student never drags the multi-KB template over the wire
+    fingerprint_template = deferred(Column(String, nullable=False))
+    __table_args__ = (
+        # Hash index: equality-only lookups, and templates can exceed the btree row size limit
+        Index("ix_students_fingerprint_template", "fingerprint_template", postgresql_using="hash"),
+        # Enrollment list download and its ETag aggregate
+        Index("ix_students_department_level", "department_id", "level_id"),
+    )
 
 class CourseList(Base):
     __tablename__ = "course_lists"
@@ -67,6 +140,11 @@ class CourseList(Base):
     course_id = Column(Integer, ForeignKey("courses.course_id"))
     matriculation_number = Column(String, ForeignKey("students.matriculation_number"))
     ca_mark = Column(Float, nullable=True)
+    __table_args__ = (
+        Index("ix_course_lists_course_matric", "course_id", "matriculation_number"),
+        # Enrollment status looks up a student's courses without knowing the course
+        Index("ix_course_lists_matric", "matriculation_number"),
+    )
 
 class ExamSession(Base):
     __tablename__ = "exam_sessions"
@@ -75,6 +153,11 @@ class ExamSession(Base):
     admin_id = Column(Integer, ForeignKey("admins.admin_id"))
     start_time = Column(DateTime, nullable=False)
     end_time = Column(DateTime, nullable=False)
+    __table_args__ = (
+        Index("ix_exam_sessions_admin_end", "admin_id", "end_time"),
+        Index("ix_exam_sessions_end_time", "end_time"),
+        Index("ix_exam_sessions_course_window", "course_id", "start_time", "end_time"),
+    )
 
 class Attendance(Base):
     __tablename__ = "attendance"
@@ -82,7 +165,15 @@ class Attendance(Base):
     session_id = Column(Integer, ForeignKey("exam_sessions.session_id"))
     matriculation_number = Column(String, ForeignKey("students.matriculation_number"))
     authenticated = Column(Boolean, default=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=utcnow)
+    __table_args__ = (
+        # Duplicate check on authenticate and the report's LEFT JOIN both probe (session, student);
+        # on PostgreSQL the included columns let both be answered from the index alone
+        Index(
+            "ix_attendance_session_matric", "session_id", "matriculation_number",
+            postgresql_include=["authenticated", "timestamp"]
+        ),
+    )
 
 class ErrorLog(Base):
     __tablename__ = "error_logs"
@@ -91,7 +182,11 @@ class ErrorLog(Base):
     matriculation_number = Column(String, ForeignKey("students.matriculation_number"))
     error_type = Column(String)
     details = Column(String)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=utcnow)
+    __table_args__ = (
+        # Error report, its ETag version query and the expired-session purge all filter by session
+        Index("ix_error_logs_session", "session_id"),
+    )
 
 class Admin(Base):
     __tablename__ = "admins"
@@ -1,14 +1,33 @@
+import hashlib
+import hmac
+import os
+import time
+from anyio import CapacityLimiter, to_thread
+from cachetools import TTLCache
 from fastapi import Security, HTTPException, Depends
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from datetime import datetime, timedelta
-from app.config import SECRET_KEY, ALGORITHM
-from app.models import Admin, get_db
-from sqlalchemy.orm import Session
+from datetime import datetime, timedelta, timezone
+from app.config import SECRET_KEY_BYTES, ALGORITHM, BCRYPT_ROUNDS
+from app.cache import get_admin_by_username
+from app.models import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
 
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# Successful verifications are remembered briefly so repeated logins skip bcrypt.
+# Keys are HMAC-SHA256 digests of (hash, password) under SECRET_KEY, so a leaked key can't be
+# brute-forced offline at SHA-256 speed, bypassing bcrypt's work factor, without also having the secret.
+# Failures are never cached: that would make wrong passwords for real usernames faster than
+# unknown usernames (which always pay burn_password_check) and leak which usernames exist.
+_verified = TTLCache(maxsize=1024, ttl=30)
+_hash_limiter = None
+
+# Decoded JWT payloads by token, so a client's repeated requests skip the signature check;
+# expiry is still enforced on every hit
+_decoded_tokens = TTLCache(maxsize=4096, ttl=60)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -16,19 +35,57 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def _run_hashing(func, *args):
+    # bcrypt is pure CPU: cap it at one thread per core so a login burst can't take every threadpool token
+    global _hash_limiter
+    if _hash_limiter is None:
+        _hash_limiter = CapacityLimiter(os.cpu_count() or 1)
+    return await to_thread.run_sync(func, *args, limiter=_hash_limiter)
+
+async def check_password(plain_password, hashed_password):
+    key = hmac.new(SECRET_KEY_BYTES, f"{hashed_password}\0{plain_password}".encode("utf-8"), hashlib.sha256).digest()
+    if key in _verified:
+        return True
+    if not await _run_hashing(verify_password, plain_password, hashed_password):
+        return False
+    _verified[key] = True
+    return True
+
+async def hash_password(password):
+    return await _run_hashing(get_password_hash, password)
+
+_dummy_hash = None
+
+async def burn_password_check(plain_password):
+    # Unknown usernames still pay for one bcrypt verify, so a miss takes as long as a wrong password
+    # and login timing doesn't reveal which usernames exist
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await hash_password(os.urandom(24).hex())
+    await _run_hashing(verify_password, plain_password, _dummy_hash)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=60)
+    expire = datetime.now(timezone.utc) + timedelta(minutes=60)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-
-def get_current_admin(credentials: HTTPAuthorizationCredentials = Security(security), db: Session = Depends(get_db)):
+    return jwt.encode(to_encode, SECRET_KEY_BYTES, algorithm=ALGORITHM)
+
+def decode_token(token):
+    payload = _decoded_tokens.get(token)
+    if payload is None:
+        payload = jwt.decode(token, SECRET_KEY_BYTES, algorithms=[ALGORITHM])
+        _decoded_tokens[token] = payload
+    elif payload.get("exp", 0) <= time.time():
+        raise JWTError("Signature has expired.")
+    return payload
+
+async def get_current_admin(credentials: HTTPAuthorizationCredentials = Security(security), db: AsyncSession = Depends(get_db)):
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(credentials.credentials)
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        admin = db.query(Admin).filter(Admin.username == username).first()
+        admin = await get_admin_by_username(db, username)
         if not admin:
             raise HTTPException(status_code=401, detail="Admin not found")
         return admin
@@ -61,7 +118,7 @@ def get_current_admin(credentials: HTTPAuthorizationCredentials = Security(secur
 
 # def create_access_token(data: dict):
 #     to_encode = data.copy()
-#     expire = datetime.utcnow() + timedelta(minutes=60)
+#     expire = datetime.now(timezone.utc) + timedelta(minutes=60)
 #     to_encode.update({"exp": expire})
 #     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
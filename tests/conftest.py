@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# app.config reads the environment at import time, so point it at a throwaway database first.
+# Set TEST_DATABASE_URL to a disposable PostgreSQL database to also exercise the COPY paths.
+_tmp_dir = tempfile.mkdtemp(prefix="authentify_test_")
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}")
+os.environ["SECRET_KEY"] = "test-secret"
+os.environ["REPORT_CACHE_DIR"] = os.path.join(_tmp_dir, "reports")
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import cache, security  # noqa: E402
+from app.config import REPORT_CACHE_DIR  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import Base, Course, Department, Level, School, SessionLocal, University, create_schema, engine  # noqa: E402
+
+
+async def _reset_database():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(create_schema)
+    async with SessionLocal() as db:
+        db.add_all([
+            University(university_id=1, name="UBa"),
+            School(school_id=1, name="Science", university_id=1),
+            Department(department_id=1, name="Computer Science", school_id=1),
+            Department(department_id=2, name="Physics", school_id=1),
+            Level(level_id=1, name="200", department_id=1),
+            Level(level_id=2, name="200", department_id=2),
+            Course(course_id=1, course_code="CSC201", course_name="Data Structures", department_id=1, level_id=1),
+        ])
+        await db.commit()
+
+
+@pytest.fixture
+def client():
+    # Every test starts from freshly seeded tables, so nothing cached by an earlier test may survive either
+    for ttl_cache in (
+        cache.course_by_code, cache.course_by_id, cache.admin_by_username, cache.department_by_id, cache.level_by_id,
+        security._verified, security._decoded_tokens,
+    ):
+        ttl_cache.clear()
+    shutil.rmtree(REPORT_CACHE_DIR, ignore_errors=True)
+    with TestClient(app) as test_client:
+        test_client.portal.call(_reset_database)
+        yield test_client
+
+
+@pytest.fixture
+def signup(client):
+    def signup(username, department_id=1):
+        response = client.post("/auth/signup", json={"username": username, "password": "pw", "department_id": department_id})
+        assert response.status_code == 200, response.text
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    return signup
+
+
+@pytest.fixture
+def admin_headers(signup):
+    return signup("admin")
+
+
+@pytest.fixture
+def enroll(client, admin_headers):
+    def enroll(matriculation_number, photo=None, department_id=1, level_id=1, headers=admin_headers):
+        return client.post("/enrollment/enroll", headers=headers, data={
+            "matriculation_number": matriculation_number,
+            "name": f"Student {matriculation_number}",
+            "department_id": department_id,
+            "level_id": level_id,
+            "fingerprint_template": f"fp-{matriculation_number}",
+        }, files={"photo": ("photo.png", photo, "image/png")} if photo else None)
+    return enroll
+
+
+@pytest.fixture
+def db_fetch(client):
+    # Runs a statement on the app's own engine and event loop
+    def fetch(statement):
+        async def run():
+            async with SessionLocal() as db:
+                return (await db.execute(statement)).all()
+        return client.portal.call(run)
+    return fetch
+
+
+@pytest.fixture
+def db_add(client):
+    def add(*rows):
+        async def run():
+            async with SessionLocal() as db:
+                db.add_all(rows)
+                await db.commit()
+        client.portal.call(run)
+    return add
@@ -0,0 +1,135 @@
+import glob
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+
+from app import cache
+from app.config import REPORT_CACHE_DIR
+from app.models import Attendance, CourseList, ExamSession
+
+PNG = b"\x89PNG\r\n\x1a\nfake-image"
+
+
+def upload(client, headers, body, course_id=1):
+    return client.post(f"/course/upload?course_id={course_id}", headers=headers, files={"file": ("roster.csv", body, "text/csv")})
+
+
+def cached_reports(kind):
+    return glob.glob(os.path.join(REPORT_CACHE_DIR, f"report_*_{kind}_*.csv"))
+
+
+def test_cached_admin_survives_a_rolled_back_request(client, admin_headers):
+    cache.admin_by_username.clear()
+    # Loads the admin into the cache, then fails and rolls back the same session
+    response = client.post("/attendance/authenticate", headers=admin_headers, json={"session_id": 999, "fingerprint_template": "x"})
+    assert "Session not found" in response.text
+    assert client.get("/courses", headers=admin_headers).status_code == 200
+
+
+def test_cached_level_survives_a_rolled_back_enrollment(client, enroll):
+    assert enroll("M1").status_code == 200
+    cache.department_by_id.clear()
+    cache.level_by_id.clear()
+    assert enroll("M1").status_code == 400  # duplicate; rolls back the session that filled the caches
+    assert enroll("M2").status_code == 200
+
+
+def test_batch_enrollment_keeps_its_own_status_codes(client, admin_headers):
+    student = {"matriculation_number": "P1", "name": "P", "department_id": 2, "level_id": 2, "fingerprint_template": "fp-P1"}
+    response = client.post("/enrollment/enroll_batch", headers=admin_headers, json=[student])
+    assert response.status_code == 403
+    assert response.json()["detail"] == "Not authorized for this department"
+
+    too_many = [{**student, "matriculation_number": f"B{i}", "department_id": 1, "level_id": 1} for i in range(1001)]
+    assert client.post("/enrollment/enroll_batch", headers=admin_headers, json=too_many).status_code == 422
+
+
+def test_enrollment_list_etag(client, admin_headers, enroll):
+    assert enroll("M1").status_code == 200
+    response = client.get("/enrollment/list/1/1", headers=admin_headers)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        assert client.get("/enrollment/list/1/1", headers={**admin_headers, "If-None-Match": if_none_match}).status_code == 304
+    assert client.get("/enrollment/list/1/1", headers={**admin_headers, "If-None-Match": '"other"'}).status_code == 200
+
+    assert enroll("M2").status_code == 200
+    response = client.get("/enrollment/list/1/1", headers={**admin_headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert "M2" in response.text
+
+
+def test_course_upload_replaces_previous_rows(client, admin_headers, enroll, db_fetch):
+    for matric in ("M1", "M2"):
+        assert enroll(matric).status_code == 200
+    assert upload(client, admin_headers, b"matriculation_number,name,ca_mark\nM1,A,10\nM2,B,20\nUNKNOWN,C,5\n").status_code == 200
+    assert upload(client, admin_headers, b"matriculation_number,name,ca_mark\nM1,A,15\n").status_code == 200
+    # A failed upload rolls back as a whole and leaves the previous rows in place
+    assert upload(client, admin_headers, b"matriculation_number,name\nM1,A\n").status_code == 400
+
+    rows = db_fetch(select(CourseList.matriculation_number, CourseList.ca_mark).where(CourseList.course_id == 1))
+    assert sorted(rows) == [("M1", 15.0), ("M2", 20.0)]
+
+
+def test_ended_session_reports_are_cached_and_invalidated(client, admin_headers, enroll, db_add):
+    assert enroll("M1").status_code == 200
+    assert enroll("M2").status_code == 200
+    assert upload(client, admin_headers, b"matriculation_number,name,ca_mark\nM1,A,10\n").status_code == 200
+    db_add(ExamSession(session_id=7, course_id=1, admin_id=1, start_time=datetime(2020, 1, 1, 9), end_time=datetime(2020, 1, 1, 12)))
+
+    first = client.get("/reports/attendance/7", headers=admin_headers)
+    assert first.status_code == 200
+    assert len(cached_reports("attendance")) == 1
+    second = client.get("/reports/attendance/7", headers=admin_headers)
+    assert second.content == first.content
+    assert second.headers["etag"] == first.headers["etag"]
+
+    # A new roster drops the cached attendance report and changes its version
+    assert upload(client, admin_headers, b"matriculation_number,name,ca_mark\nM2,B,12\n").status_code == 200
+    assert cached_reports("attendance") == []
+    third = client.get("/reports/attendance/7", headers={**admin_headers, "If-None-Match": first.headers["etag"]})
+    assert third.status_code == 200
+    assert "M2" in third.text
+
+    assert "CA_MARK_ISSUE" not in client.get("/reports/errors/7", headers=admin_headers).text
+    assert len(cached_reports("error")) == 1
+    response = client.post("/attendance/dispute", json={"session_id": 7, "matriculation_number": "M1", "course_id": 1, "details": "mark missing"})
+    assert response.status_code == 200
+    assert cached_reports("error") == []
+    assert "CA_MARK_ISSUE" in client.get("/reports/errors/7", headers=admin_headers).text
+
+
+def test_authentication_records_attendance_once(client, admin_headers, enroll, db_fetch):
+    assert enroll("M1", photo=PNG).status_code == 200
+    assert upload(client, admin_headers, b"matriculation_number,name,ca_mark\nM1,A,10\n").status_code == 200
+    now = datetime.now(timezone.utc)
+    response = client.post("/session/", headers=admin_headers, json={
+        "course_code": "CSC201",
+        "start_time": (now - timedelta(hours=1)).isoformat(),
+        "end_time": (now + timedelta(hours=1)).isoformat(),
+    })
+    assert response.status_code == 200, response.text
+    session_id = response.json()["session_id"]
+
+    auth = {"session_id": session_id, "fingerprint_template": "fp-M1"}
+    first = client.post("/attendance/authenticate", headers=admin_headers, json=auth).json()
+    second = client.post("/attendance/authenticate", headers=admin_headers, json=auth).json()
+    assert first["message"] == "Student authenticated successfully"
+    assert second["message"] == "Student already authenticated"
+    assert first["photo_url"] == second["photo_url"] == "/students/M1/photo"
+    assert "photo" not in first
+    assert db_fetch(select(func.count()).select_from(Attendance).where(Attendance.session_id == session_id)) == [(1,)]
+
+
+def test_student_photo_is_scoped_to_the_department(client, admin_headers, enroll, signup):
+    assert enroll("M1", photo=PNG).status_code == 200
+    assert enroll("M2").status_code == 200
+
+    response = client.get("/students/M1/photo", headers=admin_headers)
+    assert response.status_code == 200
+    assert response.content == PNG
+    assert response.headers["content-type"] == "image/png"
+    assert client.get("/students/M2/photo", headers=admin_headers).status_code == 404
+    assert client.get("/students/M1/photo", headers=signup("physics", department_id=2)).status_code == 403